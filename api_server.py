@@ -1,18 +1,35 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+import json
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
+import asyncio
+import hashlib
 import os
+import sys
+import time
+import faiss
+import httpx
+import numpy as np
 import mlflow
-# We use standard synchronous retry logic which is much more stable on Windows
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception
 from langchain_google_genai.chat_models import ChatGoogleGenerativeAIError
-from google.genai.errors import ClientError
+from google.genai.errors import APIError
+from cached_embeddings import CachedEmbeddings
+from mmap_docstore import MmapDocstore
+from cachetools import TTLCache
+
+# The selector event loop avoids the Windows Proactor crash that forced
+# the old synchronous fallback
+if sys.platform == "win32":
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 load_dotenv()
-app = FastAPI(title="EndoMatch API", version="2.0-Stable")
+app = FastAPI(title="EndoMatch API", version="2.5-Parallel")
 
 # --- CONFIG ---
 mlflow.set_tracking_uri("file:./mlruns")
@@ -21,88 +38,424 @@ mlflow.set_experiment("EndoMatch_Production")
 vector_db = None
 embeddings = None
 llm = None
+us_ids = None
+
+# Cap in-flight Gemini calls so gather fan-out can't trip the provider's
+# rate limit and spiral into retry backoff
+LLM_SEM = asyncio.Semaphore(int(os.getenv("LLM_MAX_CONCURRENCY", "8")))
+
+# Memoize Gemini calls by prompt hash - the cache holds the asyncio task,
+# not just the finished response, so concurrent identical prompts (two
+# equal summaries in one /match_batch) coalesce onto a single round-trip
+# and repeats within the TTL skip Gemini entirely
+LLM_CACHE = TTLCache(maxsize=2048, ttl=3600)
+
+# Spans are enqueued by request handlers and written to MLflow by a
+# background task, keeping filesystem I/O off the request path.
+# The task handle must stay referenced - the loop only holds weak refs,
+# so an anonymous task can be garbage-collected mid-flight
+TRACE_Q = None
+TRACE_TASK = None
+
+def _write_trace_batch(batch):
+    with mlflow.start_run(nested=True):
+        mlflow.log_dict({"spans": batch}, f"traces/{int(time.time() * 1000)}.json")
+
+async def trace_writer():
+    """Drain trace spans and batch-write them to the MLflow store."""
+    batch = []
+    while True:
+        batch.append(await TRACE_Q.get())
+        while not TRACE_Q.empty() and len(batch) < 64:
+            batch.append(TRACE_Q.get_nowait())
+        try:
+            # The filesystem write is still blocking - run it on a worker
+            # thread so the event loop keeps serving requests
+            await asyncio.to_thread(_write_trace_batch, batch)
+        except Exception as e:
+            print(f"⚠️ Trace write failed: {e}")
+        batch = []
+
+def record_span(span):
+    """Enqueue a span; drop it rather than block when the queue is full."""
+    if TRACE_Q is None:
+        return
+    try:
+        TRACE_Q.put_nowait(span)
+    except asyncio.QueueFull:
+        pass
 
 @app.on_event("startup")
 def load_resources():
-    global vector_db, embeddings, llm
+    global vector_db, embeddings, llm, us_ids, TRACE_Q, TRACE_TASK
     print("Loading AI Models...")
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-    
+    TRACE_Q = asyncio.Queue(maxsize=1024)
+    TRACE_TASK = asyncio.get_event_loop().create_task(trace_writer())
+    # Let FAISS parallelize the scan kernel across all cores
+    faiss.omp_set_num_threads(os.cpu_count())
+    # Prefer the INT8 ONNX backend when the exported model is present -
+    # ~2x embedding throughput on CPU with no observable recall loss
+    if os.path.isdir("onnx_minilm"):
+        from onnx_minilm import ONNXMiniLM
+        print("⚡ Using INT8 ONNX embeddings")
+        base_embeddings = ONNXMiniLM()
+    else:
+        # encode_kwargs must match the ETL so cached vectors are interchangeable
+        base_embeddings = HuggingFaceEmbeddings(
+            model_name="all-MiniLM-L6-v2",
+            cache_folder=os.getenv("MODEL_CACHE_DIR"),
+            model_kwargs={"device": "cpu"},
+            encode_kwargs={"batch_size": 256, "normalize_embeddings": True}
+        )
+    embeddings = CachedEmbeddings(base_embeddings)
+
+    index_dir = "faiss_production_index"
     try:
-        vector_db = FAISS.load_local("faiss_production_index", embeddings, allow_dangerous_deserialization=True)
-        print("✅ Database Loaded.")
-    except:
-        print("❌ Database NOT found. Run 'python etl.py' first.")
+        if os.path.exists(os.path.join(index_dir, "docstore.arrow")):
+            # Mmap the raw index and the columnar docstore. faiss only
+            # honors IO_FLAG_MMAP for some index types, so fall back to a
+            # plain in-RAM read when it refuses
+            index_path = os.path.join(index_dir, "index.faiss")
+            try:
+                index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP)
+            except RuntimeError:
+                index = faiss.read_index(index_path)
+            vector_db = FAISS(
+                embedding_function=embeddings,
+                index=index,
+                docstore=MmapDocstore(os.path.join(index_dir, "docstore.arrow")),
+                index_to_docstore_id={i: str(i) for i in range(index.ntotal)},
+                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+            )
+        else:
+            # Legacy pickled artifact from an older ETL run. It was built
+            # with IndexFlatL2 over unnormalized vectors, so keep the L2
+            # default - labelling it MAX_INNER_PRODUCT would silently
+            # shift rankings versus baseline
+            vector_db = FAISS.load_local(
+                index_dir, embeddings,
+                allow_dangerous_deserialization=True
+            )
+        # The selector file only exists for indexes built by the current
+        # ETL - a legacy artifact without it still serves, just unfiltered
+        us_path = os.path.join(index_dir, "us_ids.npy")
+        if os.path.exists(us_path):
+            us_ids = np.load(us_path)
+            print(f"✅ Database Loaded ({len(us_ids)} US trials).")
+        else:
+            print("✅ Database Loaded (no US-trial selector, serving unfiltered).")
+    except (FileNotFoundError, RuntimeError, ValueError) as e:
+        print(f"❌ Database NOT found. Run 'python etl.py' first. ({e})")
     
-    llm = ChatGoogleGenerativeAI(
+    llm_kwargs = dict(
         model="gemini-2.5-flash-preview-09-2025",
         temperature=0,
-        google_api_key= os.getenv("API_KEY")
-
+        google_api_key=os.getenv("API_KEY")
     )
+    try:
+        # Share one HTTP/2 connection pool across all concurrent audits so
+        # gather fan-out multiplexes over a single TLS connection instead
+        # of paying a handshake per call
+        from google.genai.types import HttpOptions
+        llm = ChatGoogleGenerativeAI(
+            **llm_kwargs,
+            http_options=HttpOptions(async_client_args={
+                "http2": True,
+                "limits": httpx.Limits(max_connections=64,
+                                       max_keepalive_connections=32),
+            })
+        )
+    except Exception as e:
+        # Older langchain-google-genai without the http_options passthrough
+        print(f"⚠️ Shared HTTP client unsupported, using SDK default: {e}")
+        llm = ChatGoogleGenerativeAI(**llm_kwargs)
 
 @app.get("/")
 def home():
-    return {"status": "online", "mode": "stable_sequential"}
+    return {"status": "online", "mode": "parallel_async"}
+
+def dedupe_trials(docs, k: int):
+    """Keep the top-k distinct trials from an over-fetched result list.
+
+    ClinicalTrials.gov re-posts protocol amendments, so neighbouring
+    vectors can share an nct_id - each duplicate would waste a Gemini
+    call downstream. Falls back to a content hash when the id is missing.
+    """
+    seen = set()
+    unique = []
+    for doc in docs:
+        key = doc.metadata.get('nct_id')
+        if not key or key == 'Unknown':
+            key = hashlib.sha256(doc.page_content.encode()).hexdigest()
+        if key in seen:
+            continue
+        seen.add(key)
+        unique.append(doc)
+        if len(unique) == k:
+            break
+    return unique
 
-@mlflow.trace(name="FAISS_Retrieve")
 def retrieve_trials(query: str, k: int = 3):
     if not vector_db: return []
-    # Strict US Filter
- # Filter removed to match new ETL data structure
-    return vector_db.similarity_search(query, k=k)
-# --- STABLE SYNC RETRY ---
+    # Embed through the cache once, then search by vector - repeat queries
+    # skip the MiniLM forward pass. Over-fetch 2k so dedup can still
+    # return k distinct trials
+    vec = embeddings.embed_query(query)
+
+    # Strict US filter, applied inside the FAISS scan via IDSelector so
+    # non-US vectors are skipped in C++ instead of post-filtered in Python.
+    # IDSelectorBatch is hash-set membership - O(1) per visited node,
+    # where IDSelectorArray would rescan the id list every time
+    if us_ids is not None and len(us_ids) > 0:
+        xq = np.asarray([vec], dtype="float32")
+        params = faiss.SearchParametersHNSW(sel=faiss.IDSelectorBatch(us_ids))
+        _, indices = vector_db.index.search(xq, k * 2, params=params)
+        docs = [
+            vector_db.docstore.search(vector_db.index_to_docstore_id[i])
+            for i in indices[0] if i != -1
+        ]
+    else:
+        docs = vector_db.similarity_search_by_vector(vec, k=k * 2)
+
+    return dedupe_trials(docs, k)
+
+def retrieve_trials_batch(queries, k: int = 3):
+    """Retrieve for many patient summaries with one stacked FAISS search.
+
+    FAISS turns an (N, d) query matrix into a single BLAS GEMM instead of
+    N independent scans.
+    """
+    # An empty matrix has shape (0,), which index.search rejects
+    if not queries or not vector_db:
+        return [[] for _ in queries]
+    xq = np.asarray(embeddings.embed_documents(queries), dtype="float32")
+    params = None
+    if us_ids is not None and len(us_ids) > 0:
+        params = faiss.SearchParametersHNSW(sel=faiss.IDSelectorBatch(us_ids))
+    _, indices = vector_db.index.search(xq, k * 2, params=params)
+    return [
+        dedupe_trials(
+            [vector_db.docstore.search(vector_db.index_to_docstore_id[i])
+             for i in row if i != -1],
+            k
+        )
+        for row in indices
+    ]
+# cl100k_base is a close enough proxy for Gemini's tokenizer to budget
+# prompt length without a network round-trip. get_encoding downloads the
+# BPE file on first use (the Docker image pre-bakes it via
+# TIKTOKEN_CACHE_DIR), so fall back to the char heuristic on ANY failure
+# rather than letting a blocked fetch kill the server at import
+try:
+    import tiktoken
+    _TOKENIZER = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _TOKENIZER = None
+
+CRITERIA_TOKEN_BUDGET = 700
+
+# Static prompt chunks, joined per call - the fixed text is built once at
+# import instead of re-interpolated for every (request, doc) pair
+_PROMPT_HEAD = "Act as a Clinical Trial Auditor.\nPatient: "
+_PROMPT_PHASE = "\nTrial Phase: "
+_PROMPT_CRITERIA = "\nCriteria: "
+_PROMPT_TAIL = "\n\nIs the patient ELIGIBLE? Start with YES, NO, or MAYBE. Then explain why."
+
+def truncate_to_tokens(text, budget=CRITERIA_TOKEN_BUDGET):
+    """Truncate text at a token boundary instead of mid-token char slice."""
+    if _TOKENIZER is None:
+        # ~4 chars per token heuristic when tiktoken is unavailable
+        return text[:budget * 4]
+    tokens = _TOKENIZER.encode(text)
+    if len(tokens) <= budget:
+        return text
+    return _TOKENIZER.decode(tokens[:budget])
+
+# --- ASYNC RETRY ---
+RETRIABLE_STATUS = {429, 500, 502, 503, 504}
+
+def is_retriable(exc):
+    """Retry only transient provider failures, not e.g. auth or bad-request.
+
+    APIError is the common base of the SDK's ClientError (4xx) and
+    ServerError (5xx) - checking ClientError alone would fail fast on
+    transient 5xx responses.
+    """
+    if isinstance(exc, APIError):
+        status = getattr(exc, "code", None) or getattr(exc, "status_code", None)
+        return status in RETRIABLE_STATUS
+    return isinstance(exc, ChatGoogleGenerativeAIError)
+
+# Random-exponential jitter starts retries at ~200ms and decorrelates the
+# k concurrent calls so they don't all retry in lockstep
 @retry(
-    retry=retry_if_exception_type((ClientError, ChatGoogleGenerativeAIError)),
-    wait=wait_exponential(multiplier=1, min=2, max=10),
+    retry=retry_if_exception(is_retriable),
+    wait=wait_random_exponential(multiplier=0.2, max=8),
     stop=stop_after_attempt(5)
 )
-def generate_audit_sync(prompt):
-    # We use invoke (blocking) instead of ainvoke to prevent Windows Event Loop crashes
-    return llm.invoke(prompt)
+async def _generate_audit(prompt):
+    async with LLM_SEM:
+        return await llm.ainvoke(prompt)
+
+async def async_generate_audit(prompt):
+    # Key on model too so a model swap invalidates old answers
+    key = hashlib.blake2b(
+        f"{llm.model}:{prompt}".encode(), digest_size=16
+    ).hexdigest()
+    task = LLM_CACHE.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_generate_audit(prompt))
+        LLM_CACHE[key] = task
+    try:
+        return await task
+    except Exception:
+        # Don't serve a failed call to future requests
+        LLM_CACHE.pop(key, None)
+        raise
+
+async def audit_single_trial(doc, summary):
+    """Audit one retrieved trial against the patient summary.
+
+    The static preamble and patient summary lead the prompt so the prefix
+    is byte-identical across the k trials - Gemini's implicit prefix
+    caching can then reuse the KV for everything before the criteria.
+    """
+    prompt = "".join((
+        _PROMPT_HEAD, summary,
+        _PROMPT_PHASE, doc.metadata.get('phase', 'Unknown'),
+        _PROMPT_CRITERIA, truncate_to_tokens(doc.page_content),
+        _PROMPT_TAIL,
+    ))
+
+    response = await async_generate_audit(prompt)
+
+    return {
+        "nct_id": doc.metadata.get('nct_id', 'N/A'),
+        "title": doc.metadata.get('title', 'Untitled'),
+        "phase": doc.metadata.get('phase', 'N/A'),
+        "url": doc.metadata.get('url', '#'),
+        "analysis": response.content
+    }
+
+def audit_error(doc, exc):
+    """Per-trial result dict for a failed audit."""
+    return {
+        "nct_id": doc.metadata.get('nct_id', 'N/A'),
+        "title": doc.metadata.get('title', 'Untitled'),
+        "phase": doc.metadata.get('phase', 'N/A'),
+        "url": doc.metadata.get('url', '#'),
+        "analysis": f"⚠️ AI Error: {str(exc)}"
+    }
 
 class PatientRequest(BaseModel):
-    summary: str 
+    summary: str
+
+class BatchPatientRequest(BaseModel):
+    summaries: list[str]
+
+# Embedding runs synchronously on the event loop, so keep batches small
+# enough that one request can't stall everyone else's
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "32"))
 
 @app.post("/match")
 async def match_trials(patient: PatientRequest):
     if not vector_db:
         raise HTTPException(status_code=500, detail="Database not loaded")
 
-    # Start MLflow run
-    with mlflow.start_run(nested=True):
-        
-        # 1. Retrieve Docs
-        docs = retrieve_trials(patient.summary, k=3)
-        
-        results = []
-        # 2. Sequential Loop (Safe & Reliable)
-        for doc in docs:
-            prompt = f"""
-            Act as a Clinical Trial Auditor.
-            Patient: {patient.summary}
-            Trial Phase: {doc.metadata.get('phase', 'Unknown')}
-            Criteria: {doc.page_content[:2500]}
-            
-            Is the patient ELIGIBLE? Start with YES, NO, or MAYBE. Then explain why.
-            """
-            
-            try:
-                # Synchronous call - won't crash your internet connection
-                response = generate_audit_sync(prompt)
-                analysis_content = response.content
-            except Exception as e:
-                analysis_content = f"⚠️ AI Error: {str(e)}"
-            
-            results.append({
-                "nct_id": doc.metadata.get('nct_id', 'N/A'),
-                "title": doc.metadata.get('title', 'Untitled'),
-                "phase": doc.metadata.get('phase', 'N/A'),
-                "url": doc.metadata.get('url', '#'),
-                "analysis": analysis_content
-            })
-            
-        return {"matches": results}
+    start = time.perf_counter()
+
+    # 1. Retrieve Docs
+    docs = retrieve_trials(patient.summary, k=3)
+    retrieval_ms = (time.perf_counter() - start) * 1000
+
+    # 2. Audit all trials concurrently - wall time is max(latency), not sum
+    outcomes = await asyncio.gather(
+        *[audit_single_trial(doc, patient.summary) for doc in docs],
+        return_exceptions=True
+    )
+
+    results = [
+        audit_error(doc, outcome) if isinstance(outcome, Exception) else outcome
+        for doc, outcome in zip(docs, outcomes)
+    ]
+
+    record_span({
+        "endpoint": "/match",
+        "retrieval_ms": retrieval_ms,
+        "total_ms": (time.perf_counter() - start) * 1000,
+        "num_docs": len(docs),
+    })
+    return {"matches": results}
+
+@app.post("/match_stream")
+async def match_trials_stream(patient: PatientRequest):
+    """Stream one NDJSON match per line as each trial audit finishes.
+
+    The client starts rendering after the fastest Gemini call instead of
+    waiting for the slowest.
+    """
+    if not vector_db:
+        raise HTTPException(status_code=500, detail="Database not loaded")
+
+    docs = retrieve_trials(patient.summary, k=3)
+
+    async def safe_audit(doc):
+        try:
+            return await audit_single_trial(doc, patient.summary)
+        except Exception as e:
+            return audit_error(doc, e)
+
+    async def ndjson_stream():
+        for next_done in asyncio.as_completed([safe_audit(doc) for doc in docs]):
+            match = await next_done
+            yield json.dumps(match, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+
+@app.post("/match_batch")
+async def match_trials_batch(batch: BatchPatientRequest):
+    if not vector_db:
+        raise HTTPException(status_code=500, detail="Database not loaded")
+    if not batch.summaries:
+        return {"matches": []}
+    if len(batch.summaries) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Batch too large: {len(batch.summaries)} summaries (max {MAX_BATCH_SIZE})"
+        )
+
+    start = time.perf_counter()
+
+    # 1. One FAISS search for all patients
+    docs_per_patient = retrieve_trials_batch(batch.summaries, k=3)
+    retrieval_ms = (time.perf_counter() - start) * 1000
+
+    # 2. Audit the full (patient x trial) grid concurrently; the
+    # semaphore keeps total fan-out within provider limits
+    grid = [
+        (p, doc)
+        for p, docs in enumerate(docs_per_patient)
+        for doc in docs
+    ]
+    outcomes = await asyncio.gather(
+        *[audit_single_trial(doc, batch.summaries[p]) for p, doc in grid],
+        return_exceptions=True
+    )
+
+    matches = [[] for _ in batch.summaries]
+    for (p, doc), outcome in zip(grid, outcomes):
+        matches[p].append(
+            audit_error(doc, outcome) if isinstance(outcome, Exception) else outcome
+        )
+
+    record_span({
+        "endpoint": "/match_batch",
+        "retrieval_ms": retrieval_ms,
+        "total_ms": (time.perf_counter() - start) * 1000,
+        "num_patients": len(batch.summaries),
+        "num_audits": len(grid),
+    })
+    return {"matches": matches}
 
 if __name__ == "__main__":
     import uvicorn
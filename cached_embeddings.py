@@ -0,0 +1,46 @@
+"""
+Content-hash cached wrapper around a LangChain embeddings model.
+Repeat queries and ETL re-runs skip the MiniLM forward pass entirely.
+"""
+import functools
+import hashlib
+
+import diskcache
+from langchain_core.embeddings import Embeddings
+
+
+class CachedEmbeddings(Embeddings):
+    """SHA-256 keyed embedding cache: in-process LRU backed by disk.
+
+    Keys include the backend class name so vectors from different models
+    (e.g. FP32 sentence-transformers vs INT8 ONNX) never cross-contaminate
+    the shared on-disk cache after a backend switch.
+    """
+
+    def __init__(self, base, cache_dir="./emb_cache", maxsize=4096):
+        self.base = base
+        self.namespace = type(base).__name__
+        self.disk = diskcache.Cache(cache_dir)
+        self._memo = functools.lru_cache(maxsize=maxsize)(self._lookup)
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.namespace}:{text}".encode()).hexdigest()
+
+    def _lookup(self, text):
+        key = self._key(text)
+        vec = self.disk.get(key)
+        if vec is None:
+            vec = self.base.embed_query(text)
+            self.disk[key] = vec
+        return vec
+
+    def embed_query(self, text):
+        return self._memo(text)
+
+    def embed_documents(self, texts):
+        # Embed only texts we have never seen, in one batched call
+        missing = [t for t in dict.fromkeys(texts) if self._key(t) not in self.disk]
+        if missing:
+            for text, vec in zip(missing, self.base.embed_documents(missing)):
+                self.disk[self._key(text)] = vec
+        return [self._memo(t) for t in texts]
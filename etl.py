@@ -2,48 +2,105 @@
 Clinical Trials ETL Pipeline
 Fetches trials from ClinicalTrials.gov and builds FAISS vector database
 """
+import asyncio
+import os
 import sys
-import requests
 
+import aiohttp
+import orjson
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
-def fetch_trials():
-    """Fetch clinical trials from ClinicalTrials.gov API"""
+API_URL = "https://clinicaltrials.gov/api/v2/studies"
+
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+
+
+def is_transient(exc):
+    """Retry rate limits, server errors and connection drops - a 400/404
+    would burn every attempt and fail anyway."""
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status in TRANSIENT_STATUS
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def parse_study(study):
+    """Extract the fields we index from one API study record."""
+    protocol = study.get('protocolSection', {})
+    ident = protocol.get('identificationModule', {})
+    desc = protocol.get('descriptionModule', {})
+    locations = protocol.get('contactsLocationsModule', {}).get('locations', [])
+
+    return {
+        'nct_id': ident.get('nctId', 'Unknown'),
+        'title': ident.get('briefTitle', 'Untitled'),
+        'summary': desc.get('briefSummary', 'No summary available'),
+        'is_us_trial': any(loc.get('country') == 'United States' for loc in locations)
+    }
+
+
+# Retry transient failures (429s, 5xx) per page with exponential backoff;
+# reraise the original error on exhaustion so the aiohttp.ClientError
+# handler in fetch_trials_async sees it instead of tenacity.RetryError
+@retry(retry=retry_if_exception(is_transient),
+       wait=wait_exponential(multiplier=1, min=1, max=30), stop=stop_after_attempt(5),
+       reraise=True)
+async def fetch_page(session, sem, params):
+    async with sem:
+        async with session.get(API_URL, params=params,
+                               timeout=aiohttp.ClientTimeout(total=30)) as response:
+            response.raise_for_status()
+            # orjson parses the ~100-study payloads faster than stdlib json
+            return orjson.loads(await response.read())
+
+
+async def fetch_trials_async(total=2000, page_size=100):
+    """Fetch clinical trials from ClinicalTrials.gov, page by page.
+
+    The v2 API chains pages via nextPageToken, so pages can't be fetched
+    out of order - but one keep-alive connection amortizes TCP/TLS setup
+    across pages, and the semaphore bounds fan-out if more query terms
+    are ever fetched concurrently.
+    """
     print("📡 Fetching trials from ClinicalTrials.gov...")
-    
-    url = "https://clinicaltrials.gov/api/v2/studies"
+
     # UPDATED: Changed query term to 'endocrinology'
-    params = {
+    base_params = {
         "query.term": "endocrinology",
-        "pageSize": 1000
+        "pageSize": page_size,
+        "fields": "IdentificationModule,DescriptionModule,ContactsLocationsModule"
     }
-    
+    sem = asyncio.Semaphore(8)
+    trials = []
+
     try:
-        response = requests.get(url, params=params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        
-        trials = []
-        for study in data.get('studies', []):
-            protocol = study.get('protocolSection', {})
-            ident = protocol.get('identificationModule', {})
-            desc = protocol.get('descriptionModule', {})
-            
-            trial = {
-                'nct_id': ident.get('nctId', 'Unknown'),
-                'title': ident.get('briefTitle', 'Untitled'),
-                'summary': desc.get('briefSummary', 'No summary available')
-            }
-            trials.append(trial)
-        
+        async with aiohttp.ClientSession() as session:
+            page_token = None
+            while len(trials) < total:
+                params = dict(base_params)
+                if page_token:
+                    params["pageToken"] = page_token
+
+                data = await fetch_page(session, sem, params)
+                trials.extend(parse_study(s) for s in data.get('studies', []))
+
+                page_token = data.get('nextPageToken')
+                if not page_token:
+                    break
+
         print(f"✅ Successfully fetched {len(trials)} trials")
         return trials
-        
-    except requests.exceptions.RequestException as e:
+
+    except aiohttp.ClientError as e:
         print(f"❌ Error fetching trials: {e}")
-        return []
+        return trials
     except Exception as e:
         print(f"❌ Unexpected error: {e}")
-        return []
+        return trials
+
+
+def fetch_trials():
+    """Fetch clinical trials from ClinicalTrials.gov API"""
+    return asyncio.run(fetch_trials_async())
 
 
 def build_vector_database(trials):
@@ -56,13 +113,32 @@ def build_vector_database(trials):
     
     try:
         # Import langchain components
-        from langchain_community.vectorstores import FAISS
+        import faiss
+        import numpy as np
+        import pyarrow as pa
         from langchain_huggingface import HuggingFaceEmbeddings
         from langchain_core.documents import Document
-        
+        from cached_embeddings import CachedEmbeddings
+
         # Initialize embeddings model
         print("📦 Loading embedding model (this may take a moment)...")
-        embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+        # Prefer the INT8 ONNX backend when the exported model is present
+        if os.path.isdir("onnx_minilm"):
+            from onnx_minilm import ONNXMiniLM
+            print("⚡ Using INT8 ONNX embeddings")
+            base_embeddings = ONNXMiniLM()
+        else:
+            # Large batches amortize tokenizer padding and
+            # Python<->Torch overhead on CPU
+            base_embeddings = HuggingFaceEmbeddings(
+                model_name="all-MiniLM-L6-v2",
+                cache_folder=os.getenv("MODEL_CACHE_DIR"),
+                model_kwargs={"device": "cpu"},
+                encode_kwargs={"batch_size": 256, "normalize_embeddings": True}
+            )
+        # Content-hash cache means repeat ETL runs skip re-embedding
+        # unchanged trial summaries
+        embeddings = CachedEmbeddings(base_embeddings)
         
         # Convert trials to Document objects
         documents = []
@@ -71,7 +147,8 @@ def build_vector_database(trials):
                 page_content=trial['summary'],
                 metadata={
                     'nct_id': trial['nct_id'],
-                    'title': trial['title']
+                    'title': trial['title'],
+                    'is_us_trial': trial.get('is_us_trial', False)
                 }
             )
             documents.append(doc)
@@ -80,12 +157,56 @@ def build_vector_database(trials):
         
         # Build FAISS index
         print("🏗️  Creating FAISS index...")
-        vector_db = FAISS.from_documents(documents, embeddings)
-        
-        # Save to disk
+        texts = [doc.page_content for doc in documents]
+        vectors = np.asarray(embeddings.embed_documents(texts), dtype="float32")
+
+        # HNSW gives sub-linear search instead of IndexFlat's brute-force
+        # scan - at this corpus size it beats IVF+PQ on recall too.
+        # fp16 scalar quantization halves the bytes streamed per distance
+        # computation (<0.5% recall loss for normalized MiniLM vectors).
+        # Vectors are L2-normalized, so inner product == cosine and the
+        # kernel is one fma per dim instead of sub+square+sum
+        index = faiss.IndexHNSWSQ(vectors.shape[1], faiss.ScalarQuantizer.QT_fp16, 32,
+                                  faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 200
+        index.hnsw.efSearch = 64
+        index.train(vectors)
+        index.add(vectors)
+
+        # Save to disk: raw FAISS index plus a columnar docstore the API
+        # memory-maps at startup, instead of a pickled Python heap
         output_dir = "faiss_production_index"
-        vector_db.save_local(output_dir)
-        print(f"💾 Successfully saved database to '{output_dir}/'")
+        os.makedirs(output_dir, exist_ok=True)
+        faiss.write_index(index, os.path.join(output_dir, "index.faiss"))
+
+        table = pa.table({
+            "id": [str(i) for i in range(len(documents))],
+            "page_content": texts,
+            "nct_id": [doc.metadata['nct_id'] for doc in documents],
+            "title": [doc.metadata['title'] for doc in documents],
+            "is_us_trial": [doc.metadata['is_us_trial'] for doc in documents],
+        })
+        # Uncompressed Arrow IPC so the API can memory-map rows lazily;
+        # parquet pages would have to be decoded eagerly at startup
+        with pa.OSFile(os.path.join(output_dir, "docstore.arrow"), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+        # Remove artifacts from older layouts (pickled docstore, parquet
+        # experiment) so the API's legacy fallback can't pick up stale data
+        for stale in ("index.pkl", "docstore.parquet"):
+            stale_path = os.path.join(output_dir, stale)
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+        # Persist US-trial FAISS ids so the API can filter inside the
+        # C++ scan instead of post-filtering in Python
+        us_ids = np.array(
+            [i for i, doc in enumerate(documents) if doc.metadata['is_us_trial']],
+            dtype=np.int64
+        )
+        np.save(os.path.join(output_dir, "us_ids.npy"), us_ids)
+        print(f"💾 Successfully saved database to '{output_dir}/' ({len(us_ids)} US trials)")
         
         return True
         
@@ -0,0 +1,44 @@
+"""
+Memory-mapped Arrow docstore for the FAISS vector store.
+The ETL writes an uncompressed Arrow IPC file, so opening it over
+pa.memory_map is zero-copy: init materializes only the id column and
+document rows page in from disk on first access. (Parquet cannot do
+this - its pages are compressed/encoded and must be decoded eagerly.)
+"""
+import pyarrow as pa
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+
+
+class MmapDocstore(Docstore):
+    """Read-only docstore over a memory-mapped Arrow IPC file.
+
+    Document ids are the stringified FAISS positions, matching the
+    index_to_docstore_id mapping the ETL writes.
+    """
+
+    def __init__(self, path):
+        self._source = pa.memory_map(path)
+        self.table = pa.ipc.open_file(self._source).read_all()
+        self._row = {
+            doc_id: i
+            for i, doc_id in enumerate(self.table.column("id").to_pylist())
+        }
+        self._meta_cols = [
+            c for c in self.table.column_names if c not in ("id", "page_content")
+        ]
+
+    def search(self, search):
+        row = self._row.get(search)
+        if row is None:
+            return f"ID {search} not found."
+        return Document(
+            page_content=self.table.column("page_content")[row].as_py(),
+            metadata={c: self.table.column(c)[row].as_py() for c in self._meta_cols},
+        )
+
+    def add(self, texts):
+        raise NotImplementedError("MmapDocstore is read-only")
+
+    def delete(self, ids):
+        raise NotImplementedError("MmapDocstore is read-only")
@@ -0,0 +1,70 @@
+"""
+INT8 ONNX Runtime embeddings for all-MiniLM-L6-v2.
+
+Export the model once (build machine or Docker layer):
+    optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 \
+        --task feature-extraction onnx_minilm/
+    python onnx_minilm.py   # writes the dynamically quantized model_int8.onnx
+
+When the onnx_minilm/ directory exists, the API server and ETL pick this
+backend up automatically in place of the PyTorch FP32 path.
+"""
+import os
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+MODEL_DIR = "onnx_minilm"
+
+
+class ONNXMiniLM(Embeddings):
+    """MiniLM embeddings via ONNX Runtime with dynamic INT8 weights."""
+
+    def __init__(self, model_dir=MODEL_DIR, batch_size=256):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_path = os.path.join(model_dir, "model_int8.onnx")
+        if not os.path.exists(model_path):
+            model_path = os.path.join(model_dir, "model.onnx")
+
+        self.session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.batch_size = batch_size
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def _encode(self, texts):
+        enc = self.tokenizer(texts, padding=True, truncation=True,
+                             max_length=256, return_tensors="np")
+        inputs = {k: v for k, v in enc.items() if k in self._input_names}
+        hidden = self.session.run(None, inputs)[0]
+
+        # Mean-pool over real tokens, then L2-normalize (same as the
+        # sentence-transformers pipeline with normalize_embeddings=True)
+        mask = enc["attention_mask"][..., None].astype(hidden.dtype)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled
+
+    def embed_documents(self, texts):
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            vectors.extend(self._encode(texts[i:i + self.batch_size]).tolist())
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def quantize():
+    """Dynamically quantize the exported FP32 model to INT8 weights."""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    src = os.path.join(MODEL_DIR, "model.onnx")
+    dst = os.path.join(MODEL_DIR, "model_int8.onnx")
+    quantize_dynamic(src, dst, weight_type=QuantType.QInt8)
+    print(f"✅ Quantized model written to '{dst}'")
+
+
+if __name__ == "__main__":
+    quantize()
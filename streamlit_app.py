@@ -1,12 +1,26 @@
 import streamlit as st
 import requests
-import time
+import json
 import os
 
 # --- CONFIGURATION ---
 # Use environment variable for API URL, fallback to local for development
 API_URL = os.getenv("API_URL", "http://127.0.0.1:8000")
 
+@st.cache_resource
+def http_session() -> requests.Session:
+    """One session per server process, so TCP connections actually
+    survive script reruns (a module-level session is rebuilt each run)."""
+    return requests.Session()
+
+@st.cache_data(ttl=10)
+def backend_online(url: str) -> bool:
+    """Probe the API at most once per 10s instead of on every rerun."""
+    try:
+        return http_session().get(url, timeout=(1, 2)).status_code == 200
+    except requests.exceptions.RequestException:
+        return False
+
 st.set_page_config(
     page_title="EndoMatch AI", 
     page_icon="🧬", 
@@ -49,14 +63,10 @@ with st.sidebar:
     
     st.markdown("---")
     st.markdown("**Backend Status:**")
-    try:
-        health_check = requests.get(f"{API_URL}/", timeout=5)
-        if health_check.status_code == 200:
-            st.success("🟢 API Online")
-        else:
-            st.error("🔴 API Offline")
-    except:
-        st.error("🔴 Connection Failed")
+    if backend_online(f"{API_URL}/"):
+        st.success("🟢 API Online")
+    else:
+        st.error("🔴 API Offline")
         st.caption(f"Trying: {API_URL}")
 
 # --- MAIN CHAT WINDOW ---
@@ -79,26 +89,33 @@ if prompt := st.chat_input("Message EndoMatch..."):
         with st.spinner("Searching protocols & analyzing eligibility..."):
             try:
                 payload = {"summary": prompt}
-                response = requests.post(f"{API_URL}/match", json=payload, timeout=30)
-                
+                # Stream NDJSON matches and render each one as it arrives
+                response = requests.post(f"{API_URL}/match_stream", json=payload, timeout=60, stream=True)
+
                 if response.status_code == 200:
-                    data = response.json()
-                    matches = data.get("matches", [])
-                    
-                    if not matches:
+                    matches_md = ""
+                    match_count = 0
+                    for line in response.iter_lines():
+                        if not line:
+                            continue
+                        match = json.loads(line)
+                        match_count += 1
+
+                        status = match['analysis'][:10].upper()
+                        icon = "✅" if "YES" in status else "❌" if "NO" in status else "⚠️"
+
+                        matches_md += (
+                            f"#### {icon} {match['title']}\n"
+                            f"**Protocol ID:** [{match['nct_id']}]({match['url']}) | **Phase:** {match['phase']}\n\n"
+                            f"> {match['analysis']}\n\n"
+                            f"---\n"
+                        )
+                        message_placeholder.markdown(matches_md + "▌")
+
+                    if match_count == 0:
                         full_response = "I searched the database but found **no matching trials** for this profile."
                     else:
-                        full_response = f"### 🔍 Found {len(matches)} Potential Matches\n\n"
-                        for match in matches:
-                            status = match['analysis'][:10].upper()
-                            icon = "✅" if "YES" in status else "❌" if "NO" in status else "⚠️"
-                            
-                            full_response += (
-                                f"#### {icon} {match['title']}\n"
-                                f"**Protocol ID:** [{match['nct_id']}]({match['url']}) | **Phase:** {match['phase']}\n\n"
-                                f"> {match['analysis']}\n\n"
-                                f"---\n"
-                            )
+                        full_response = f"### 🔍 Found {match_count} Potential Matches\n\n{matches_md}"
                 else:
                     full_response = f"⚠️ **Server Error ({response.status_code}):** {response.text[:200]}"
 
@@ -109,12 +126,5 @@ if prompt := st.chat_input("Message EndoMatch..."):
             except Exception as e:
                 full_response = f"❌ **Error:** {str(e)}"
 
-        # Stream response
-        current_text = ""
-        for chunk in full_response.split(" "):
-            current_text += chunk + " "
-            message_placeholder.markdown(current_text + "▌")
-            time.sleep(0.04)
-            
         message_placeholder.markdown(full_response)
         st.session_state.messages.append({"role": "assistant", "content": full_response})
@@ -3,7 +3,9 @@ Unit tests for ETL pipeline
 """
 import pytest
 import os
-from etl import fetch_trials, build_vector_database
+from langchain_core.documents import Document
+from etl import fetch_trials, build_vector_database, parse_study
+from api_server import dedupe_trials, truncate_to_tokens
 
 
 def test_api_connection():
@@ -58,9 +60,9 @@ def test_vector_folder_creation():
 def test_fetch_trials_returns_correct_count():
     """Verify we get the expected number of trials."""
     trials = fetch_trials()
-    
-    # We set pageSize=5 in the ETL, so we should get up to 5 trials
-    assert len(trials) <= 5, "Got more trials than expected"
+
+    # fetch_trials_async pages until the 2000-trial budget is reached
+    assert len(trials) <= 2000, "Got more trials than expected"
     assert len(trials) > 0, "Got zero trials"
 
 
@@ -75,3 +77,87 @@ def test_trial_has_valid_nct_id():
         # NCT IDs typically start with "NCT"
         assert nct_id.startswith('NCT') or nct_id == 'Unknown', \
             f"Invalid NCT ID format: {nct_id}"
+
+
+def test_parse_study_extracts_fields():
+    """parse_study should pull the id, title, summary and US flag."""
+    study = {
+        'protocolSection': {
+            'identificationModule': {'nctId': 'NCT01234567', 'briefTitle': 'Trial A'},
+            'descriptionModule': {'briefSummary': 'A study of endometriosis treatment.'},
+            'contactsLocationsModule': {'locations': [
+                {'country': 'France'},
+                {'country': 'United States'},
+            ]},
+        }
+    }
+    trial = parse_study(study)
+
+    assert trial['nct_id'] == 'NCT01234567'
+    assert trial['title'] == 'Trial A'
+    assert trial['summary'] == 'A study of endometriosis treatment.'
+    assert trial['is_us_trial'] is True
+
+
+def test_parse_study_handles_missing_modules():
+    """An empty study record should fall back to defaults."""
+    trial = parse_study({})
+
+    assert trial['nct_id'] == 'Unknown'
+    assert trial['title'] == 'Untitled'
+    assert trial['summary'] == 'No summary available'
+    assert trial['is_us_trial'] is False
+
+
+def _doc(nct_id, content="Eligibility criteria text"):
+    return Document(page_content=content, metadata={'nct_id': nct_id})
+
+
+def test_dedupe_trials_drops_duplicate_ids():
+    """Duplicate nct_ids should be collapsed to the first occurrence."""
+    docs = [_doc('NCT1'), _doc('NCT1'), _doc('NCT2'), _doc('NCT3')]
+    unique = dedupe_trials(docs, k=3)
+
+    assert [d.metadata['nct_id'] for d in unique] == ['NCT1', 'NCT2', 'NCT3']
+
+
+def test_dedupe_trials_keeps_retrieval_order_up_to_k():
+    """Dedup should preserve similarity order and stop at k results."""
+    docs = [_doc(f'NCT{i}') for i in range(6)]
+    unique = dedupe_trials(docs, k=3)
+
+    assert [d.metadata['nct_id'] for d in unique] == ['NCT0', 'NCT1', 'NCT2']
+
+
+def test_dedupe_trials_hashes_unknown_ids():
+    """Unknown ids should dedup on content instead of colliding."""
+    docs = [
+        _doc('Unknown', 'criteria A'),
+        _doc('Unknown', 'criteria A'),
+        _doc('Unknown', 'criteria B'),
+    ]
+    unique = dedupe_trials(docs, k=3)
+
+    assert len(unique) == 2
+
+
+def test_truncate_to_tokens_keeps_short_text():
+    """Text under the token budget must come back unchanged."""
+    assert truncate_to_tokens("short text") == "short text"
+
+
+def test_truncate_to_tokens_respects_budget():
+    """Text over the budget should be cut to a prefix of itself."""
+    long_text = "criteria " * 5000
+    truncated = truncate_to_tokens(long_text, budget=50)
+
+    assert len(truncated) < len(long_text)
+    assert long_text.startswith(truncated)
+
+
+def test_truncate_to_tokens_falls_back_without_tokenizer(monkeypatch):
+    """Without tiktoken the ~4-chars-per-token heuristic applies."""
+    import api_server
+    monkeypatch.setattr(api_server, "_TOKENIZER", None)
+
+    assert api_server.truncate_to_tokens("x" * 1000, budget=50) == "x" * 200